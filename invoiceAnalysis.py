@@ -14,7 +14,7 @@
 #
 """
 usage: invoiceAnalysis.py [-h] [-k apikey] [-s YYYY-MM] [-e YYYY-MM] [-m MONTHS] [--COS_APIKEY COS_APIKEY] [--COS_ENDPOINT COS_ENDPOINT] [--COS_INSTANCE_CRN COS_INSTANCE_CRN] [--COS_BUCKET COS_BUCKET] [--sendGridApi SENDGRIDAPI]      ─╯
-                          [--sendGridTo SENDGRIDTO] [--sendGridFrom SENDGRIDFROM] [--sendGridSubject SENDGRIDSUBJECT] [--output OUTPUT] [--SL_PRIVATE | --no-SL_PRIVATE]
+                          [--sendGridTo SENDGRIDTO] [--sendGridFrom SENDGRIDFROM] [--sendGridSubject SENDGRIDSUBJECT] [--output OUTPUT] [--SL_PRIVATE | --no-SL_PRIVATE] [--cache-dir CACHE_DIR] [--segment-rows SEGMENT_ROWS]
 
 Export usage detail by invoice month to an Excel file for all IBM Cloud Classic invoices and corresponding lsPaaS Consumption.
 
@@ -47,11 +47,15 @@ optional arguments:
   --output OUTPUT       Filename Excel output file. (including extension of .xlsx)
   --SL_PRIVATE, --no-SL_PRIVATE
                         Use IBM Cloud Classic Private API Endpoint (default: False)
+  --cache-dir CACHE_DIR
+                        Directory to cache invoice line items and closed months of PaaS usage in so re-runs only retrieve new data.
+  --segment-rows SEGMENT_ROWS
+                        Split the report into one Excel file per IBM invoice month when detail exceeds this many rows. (0 to disable)
 ╭
 
 """
 __author__ = 'jonhall'
-import SoftLayer, os, logging, logging.config, json, calendar, os.path, argparse, pytz, base64
+import SoftLayer, os, logging, logging.config, json, calendar, os.path, argparse, base64, io, sys, time, pickle, shelve, pathlib, hashlib
 import pandas as pd
 import numpy as np
 from sendgrid import SendGridAPIClient
@@ -59,14 +63,26 @@ from sendgrid.helpers.mail import (
     Mail, Personalization, Email, Attachment, FileContent, FileName,
     FileType, Disposition, ContentId)
 from datetime import datetime, tzinfo, timezone
-from dateutil import tz
-from calendar import monthrange
+from zoneinfo import ZoneInfo
 from dateutil.relativedelta import relativedelta
-import ibm_boto3
-from ibm_botocore.client import Config, ClientError
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from ibm_platform_services import IamIdentityV1, UsageReportsV4
 from ibm_cloud_sdk_core import ApiException
 from ibm_cloud_sdk_core.authenticators import IAMAuthenticator
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# CFTS billing cutoffs are in Dallas time, look the zone up once for the whole run
+DALLAS = ZoneInfo('US/Central')
+
+# SoftLayer object masks, built once rather than per API call.  Only request the fields getInvoiceDetail reads, for
+# children that is just the product description rather than the whole product object.
+_INVOICES_MASK = "id,createDate,typeCode,invoiceTotalAmount,invoiceTotalRecurringAmount,invoiceTopLevelItemCount"
+_TOPLEVEL_MASK = "id, billingItemId, categoryCode, category.name, hourlyFlag, hostName, domainName, product.description," \
+                 "totalRecurringAmount, totalOneTimeAmount, usageChargeFlag, hourlyRecurringFee," \
+                 "children.description, children.categoryCode, children.product.description, children.hourlyRecurringFee"
 
 def setup_logging(default_path='logging.json', default_level=logging.info, env_key='LOG_CFG'):
     # read logging.json for log parameters to be ued by script
@@ -81,87 +97,158 @@ def setup_logging(default_path='logging.json', default_level=logging.info, env_k
     else:
         logging.basicConfig(level=default_level)
 
-def getDescription(categoryCode, detail):
-    # retrieve additional description detail for child records
+def getChildren(detail):
+    # index child records by categoryCode once per item, keeping the first child found for each code
+    children = {}
     for item in detail:
         if 'categoryCode' in item:
-            if item['categoryCode'] == categoryCode:
-                return item['product']['description'].strip()
+            children.setdefault(item['categoryCode'], item)
+    return children
+
+def getDescription(categoryCode, children):
+    # retrieve additional description detail for child records
+    if categoryCode in children:
+        return children[categoryCode]['product']['description'].strip()
     return ""
 
-def getStorageServiceUsage(categoryCode, detail):
+def getStorageServiceUsage(categoryCode, children):
     # retrieve storage details for description text
-    for item in detail:
-        if 'categoryCode' in item:
-            if item['categoryCode'] == categoryCode:
-                return item['description'].strip()
+    if categoryCode in children:
+        return children[categoryCode]['description'].strip()
     return ""
 
-
-def getCFTSInvoiceDate(invoiceDate):
+def _describeEnterpriseStorage(item, children, description):
+    iops = getDescription("storage_tier_level", children)
+    storage = getDescription("performance_storage_space", children)
+    snapshot = getDescription("storage_snapshot_space", children)
+    if snapshot == "":
+        return "{} {} ".format(storage, iops)
+    return "{} {} with {}".format(storage, iops, snapshot)
+
+def _describePerformanceStorage(item, children, description):
+    iops = getDescription("performance_storage_iops", children)
+    storage = getDescription("performance_storage_space", children)
+    return "{} {}".format(storage, iops)
+
+def _describeStorageAsAService(item, children, description):
+    model = "Hourly" if item["hourlyFlag"] else "Monthly"
+    space = getStorageServiceUsage('performance_storage_space', children)
+    tier = getDescription("storage_tier_level", children)
+    if space == "" or tier == "":
+        return "{} File Storage".format(model)
+    if getDescription("storage_snapshot_space", children) == "":
+        return "{} File Storage {} at {}".format(model, space, tier)
+    snapshotspace = getStorageServiceUsage('storage_snapshot_space', children)
+    return "{} File Storage {} at {} with {}".format(model, space, tier, snapshotspace)
+
+def _describeGuestStorage(item, children, description):
+    imagestorage = getStorageServiceUsage("guest_storage_usage", children)
+    if imagestorage != "":
+        return imagestorage
+    return description
+
+# storage categories build their description from child records, dispatch on categoryCode instead of an if/elif chain
+DESCRIPTION_BUILDERS = {"storage_service_enterprise": _describeEnterpriseStorage,
+                        "performance_storage_iops": _describePerformanceStorage,
+                        "storage_as_a_service": _describeStorageAsAService,
+                        "guest_storage": _describeGuestStorage}
+
+@lru_cache(maxsize=256)
+def _last_day(year, month):
+    # last day of month, only a handful of distinct months are seen per run so cache them
+    return calendar.monthrange(year, month)[1]
+
+def _end_of_month(dt):
+    # same date and time on the last day of dt's month
+    return dt.replace(day=_last_day(dt.year, dt.month))
+
+def _servicePeriod(start):
+    # formatted service start and end of month dates for a service period starting at start
+    return start.strftime("%Y-%m-%d"), _end_of_month(start).strftime("%Y-%m-%d")
+
+# month offsets used for service dates, created once instead of per line item
+_ONE_MONTH = relativedelta(months=1)
+_TWO_MONTHS = relativedelta(months=2)
+
+@lru_cache(maxsize=None)
+def getCFTSInvoiceDate(year, month, day):
     # Determine CFTS Invoice Month (20th of prev month - 19th of current month) are on current month CFTS invoice.
-    if invoiceDate.day > 19:
-        invoiceDate = invoiceDate + relativedelta(months=1)
-    return invoiceDate.strftime('%Y-%m')
+    if day > 19:
+        year, month = divmod(year * 12 + month, 12)
+        month += 1
+    return "{}-{:02d}".format(year, month)
 
 def getInvoiceDates(startdate,enddate):
     # Adjust start and dates to match CFTS Invoice cutoffs of 20th to end of day 19th 00:00 Dallas time on the 20th
-    dallas = tz.gettz('US/Central')
-    startdate = datetime(int(startdate[0:4]),int(startdate[5:7]),20,0,0,0,tzinfo=dallas) - relativedelta(months=1)
-    enddate = datetime(int(enddate[0:4]),int(enddate[5:7]),20,0,0,0,tzinfo=dallas)
+    startdate = datetime(int(startdate[0:4]),int(startdate[5:7]),20,0,0,0,tzinfo=DALLAS) - relativedelta(months=1)
+    enddate = datetime(int(enddate[0:4]),int(enddate[5:7]),20,0,0,0,tzinfo=DALLAS)
     return startdate, enddate
 
 def getInvoiceList(startdate, enddate):
     # GET LIST OF PORTAL INVOICES BETWEEN DATES USING CENTRAL (DALLAS) TIME
-    dallas=tz.gettz('US/Central')
     logging.info("Looking up invoices from {} to {}.".format(startdate.strftime("%m/%d/%Y %H:%M:%S%z"), enddate.strftime("%m/%d/%Y %H:%M:%S%z")))
     # filter invoices based on local dallas time that correspond to CFTS UTC cutoff
     try:
-        invoiceList = client['Account'].getInvoices(mask='id,createDate,typeCode,invoiceTotalAmount,invoiceTotalRecurringAmount,invoiceTopLevelItemCount', filter={
+        invoiceList = client['Account'].getInvoices(mask=_INVOICES_MASK, filter={
                 'invoices': {
                     'createDate': {
                         'operation': 'betweenDate',
                         'options': [
-                             {'name': 'startDate', 'value': [startdate.astimezone(dallas).strftime("%m/%d/%Y %H:%M:%S")]},
-                             {'name': 'endDate', 'value': [enddate.astimezone(dallas).strftime("%m/%d/%Y %H:%M:%S")]}
+                             {'name': 'startDate', 'value': [startdate.astimezone(DALLAS).strftime("%m/%d/%Y %H:%M:%S")]},
+                             {'name': 'endDate', 'value': [enddate.astimezone(DALLAS).strftime("%m/%d/%Y %H:%M:%S")]}
                         ]
                     }
                 }
         })
     except SoftLayer.SoftLayerAPIError as e:
         logging.error("Account::getInvoices: %s, %s" % (e.faultCode, e.faultString))
-        quit()
+        sys.exit(1)
     return invoiceList
 
-def getInvoiceDetail(IC_API_KEY, SL_ENDPOINT, startdate, enddate):
+def getInvoiceItems(invoiceID, limit, offset, totalItems):
+    # GET one page of invoice top level items, retrying with exponential backoff on API errors
+    logging.info("Retrieving %s invoice line items for Invoice %s at Offset %s of %s" % (limit, invoiceID, offset, totalItems))
+    retries = 4
+    for attempt in range(retries + 1):
+        try:
+            return client['Billing_Invoice'].getInvoiceTopLevelItems(id=invoiceID, limit=limit, offset=offset, mask=_TOPLEVEL_MASK)
+        except SoftLayer.SoftLayerAPIError as e:
+            if attempt == retries:
+                logging.error("Billing_Invoice::getInvoiceTopLevelItems: %s, %s" % (e.faultCode, e.faultString))
+                # runs in a prefetch thread, raise so the main thread can stop the remaining fetches and exit
+                raise
+            logging.warning("Billing_Invoice::getInvoiceTopLevelItems: %s, %s retrying." % (e.faultCode, e.faultString))
+            time.sleep(2 ** attempt)
+
+def getInvoiceDetail(IC_API_KEY, SL_ENDPOINT, startdate, enddate, cacheDir=None):
     # GET InvoiceDetail
     global client
-    # Create dataframe to work with for classic infrastructure invoices
-    df = pd.DataFrame(columns=['Portal_Invoice_Date',
-                               'Portal_Invoice_Time',
-                               'Service_Date_Start',
-                               'Service_Date_End',
-                               'IBM_Invoice_Month',
-                               'Portal_Invoice_Number',
-                               'Type',
-                               'BillingItemId',
-                               'hostName',
-                               'Category',
-                               'Description',
-                               'Memory',
-                               'OS',
-                               'Hourly',
-                               'Usage',
-                               'Hours',
-                               'HourlyRate',
-                               'totalRecurringCharge',
-                               'NewEstimatedMonthly',
-                               'totalOneTimeAmount',
-                               'InvoiceTotal',
-                               'InvoiceRecurring',
-                               'Recurring_Description'])
-
-    dallas = tz.gettz('US/Central')
+    # Columns of dataframe to work with for classic infrastructure invoices
+    columns = ['Portal_Invoice_Date',
+               'Portal_Invoice_Time',
+               'Service_Date_Start',
+               'Service_Date_End',
+               'IBM_Invoice_Month',
+               'Portal_Invoice_Number',
+               'Type',
+               'BillingItemId',
+               'hostName',
+               'Category',
+               'Description',
+               'Memory',
+               'OS',
+               'Hourly',
+               'Usage',
+               'Hours',
+               'HourlyRate',
+               'totalRecurringCharge',
+               'NewEstimatedMonthly',
+               'totalOneTimeAmount',
+               'InvoiceTotal',
+               'InvoiceRecurring',
+               'Recurring_Description']
+    # Collect rows in a list and build the dataframe once, appending to a dataframe copies it on every row
+    rows = []
 
     # Create Classic infra API client
     client = SoftLayer.Client(username="apikey", api_key=IC_API_KEY, endpoint_url=SL_ENDPOINT)
@@ -172,193 +259,270 @@ def getInvoiceDetail(IC_API_KEY, SL_ENDPOINT, startdate, enddate):
     if invoiceList == None:
         return invoiceList
 
-    for invoice in invoiceList:
-        if float(invoice['invoiceTotalAmount']) == 0:
-            continue
+    limit = 250 ## set limit of record returned
+    invoiceList = [invoice for invoice in invoiceList if float(invoice['invoiceTotalAmount']) != 0]
 
-        invoiceID = invoice['id']
-        # To align to CFTS billing cutoffs display time in Dallas timezone.
-        invoiceDate = datetime.strptime(invoice['createDate'], "%Y-%m-%dT%H:%M:%S%z").astimezone(dallas)
-        invoiceTotalAmount = float(invoice['invoiceTotalAmount'])
-        CFTSInvoiceDate = getCFTSInvoiceDate(invoiceDate)
-
-        invoiceTotalRecurringAmount = float(invoice['invoiceTotalRecurringAmount'])
-        invoiceType = invoice['typeCode']
-        recurringDesc = ""
-        if invoiceType == "NEW":
-            serviceDateStart = invoiceDate
-            # get last day of month
-            serviceDateEnd= serviceDateStart.replace(day=calendar.monthrange(serviceDateStart.year,serviceDateStart.month)[1])
-
-        if invoiceType == "CREDIT" or invoiceType == "ONE-TIME-CHARGE":
-            serviceDateStart = invoiceDate
-            serviceDateEnd = invoiceDate
-
-        totalItems = invoice['invoiceTopLevelItemCount']
-
-        # PRINT INVOICE SUMMARY LINE
-        logging.info('Invoice: {} Date: {} Type:{} Items: {} Amount: ${:,.2f}'.format(invoiceID, datetime.strftime(invoiceDate, "%Y-%m-%d"), invoiceType, totalItems, invoiceTotalRecurringAmount))
-
-        limit = 250 ## set limit of record returned
-        for offset in range(0, totalItems, limit):
-            if ( totalItems - offset - limit ) < 0:
-                remaining = totalItems - offset
-            logging.info("Retrieving %s invoice line items for Invoice %s at Offset %s of %s" % (limit, invoiceID, offset, totalItems))
-
-            try:
-                Billing_Invoice = client['Billing_Invoice'].getInvoiceTopLevelItems(id=invoiceID, limit=limit, offset=offset,
-                                    mask="id, billingItemId, categoryCode, category.name, hourlyFlag, hostName, domainName, product.description," \
-                                         "createDate, totalRecurringAmount, totalOneTimeAmount, usageChargeFlag, hourlyRecurringFee," \
-                                         "children.description, children.categoryCode, children.product, children.hourlyRecurringFee")
-            except SoftLayer.SoftLayerAPIError as e:
-                logging.error("Billing_Invoice::getInvoiceTopLevelItems: %s, %s" % (e.faultCode, e.faultString))
-                quit()
-
-            count = 0
-            # ITERATE THROUGH DETAIL
-            for item in Billing_Invoice:
-                totalOneTimeAmount = float(item['totalOneTimeAmount'])
-                billingItemId = item['billingItemId']
-                category = item["categoryCode"]
-                categoryName = item["category"]["name"]
-                description = item['product']['description']
-                memory = getDescription("ram", item["children"])
-                os = getDescription("os", item["children"])
-
-                if 'hostName' in item:
-                    if 'domainName' in item:
-                        hostName = item['hostName']+"."+item['domainName']
-                    else:
-                        hostName = item['hostName']
-                else:
-                    hostName = ""
-
-                recurringFee = float(item['totalRecurringAmount'])
-                NewEstimatedMonthly = 0
-
-                # If Hourly calculate hourly rate and total hours
-                if item["hourlyFlag"]:
-                    # if hourly charges are previous month usage
-                    serviceDateStart = invoiceDate - relativedelta(months=1)
-                    serviceDateEnd = serviceDateStart.replace(day=calendar.monthrange(serviceDateStart.year, serviceDateStart.month)[1])
-                    recurringDesc = "IaaS Usage"
-                    hourlyRecurringFee = 0
-                    hours = 0
-                    if "hourlyRecurringFee" in item:
-                        if float(item["hourlyRecurringFee"]) > 0:
-                            hourlyRecurringFee = float(item['hourlyRecurringFee'])
-                            for child in item["children"]:
-                                if "hourlyRecurringFee" in child:
-                                    hourlyRecurringFee = hourlyRecurringFee + float(child['hourlyRecurringFee'])
-                            hours = round(float(recurringFee) / hourlyRecurringFee)            # Not an hourly billing item
-                else:
-                    if categoryName.find("Platform Service Plan") != -1:
-                        # Non Hourly PaaS Usage from actual usage two months prior
-                        serviceDateStart = invoiceDate - relativedelta(months=2)
-                        serviceDateEnd = serviceDateStart.replace(day=calendar.monthrange(serviceDateStart.year, serviceDateStart.month)[1])
-                        recurringDesc = "Platform Service Usage"
-                    else:
-                        if invoiceType == "RECURRING":
-                            serviceDateStart = invoiceDate
-                            serviceDateEnd = serviceDateStart.replace(day=calendar.monthrange(serviceDateStart.year, serviceDateStart.month)[1])
-                            recurringDesc = "IaaS Monthly"
-                    hourlyRecurringFee = 0
-                    hours = 0
-
-                # Special handling for storage
-                if category == "storage_service_enterprise":
-                    iops = getDescription("storage_tier_level", item["children"])
-                    storage = getDescription("performance_storage_space", item["children"])
-                    snapshot = getDescription("storage_snapshot_space", item["children"])
-                    if snapshot == "":
-                        description = storage + " " + iops + " "
-                    else:
-                        description = storage+" " + iops + " with " + snapshot
-                elif category == "performance_storage_iops":
-                    iops = getDescription("performance_storage_iops", item["children"])
-                    storage = getDescription("performance_storage_space", item["children"])
-                    description = storage + " " + iops
-                elif category == "storage_as_a_service":
-                    if item["hourlyFlag"]:
-                        model = "Hourly"
-                        for child in item["children"]:
-                            if "hourlyRecurringFee" in child:
-                                hourlyRecurringFee = hourlyRecurringFee + float(child['hourlyRecurringFee'])
-                        if hourlyRecurringFee>0:
-                            hours = round(float(recurringFee) / hourlyRecurringFee)
+    # Cached rows are tuples in column order, so key the file name on the column layout; files written with a different
+    # layout are simply never read.  The cache is unpickled, so only point --cache-dir at a trusted directory.
+    cacheLayout = hashlib.md5(",".join(columns).encode()).hexdigest()[:8]
+
+    def invoiceCacheFile(invoiceID):
+        return os.path.join(cacheDir, "{}.{}.pkl".format(invoiceID, cacheLayout))
+
+    # Invoices and their pages are independent requests.  Submit the pages of the next few invoices ahead of the one
+    # being processed, so fetching overlaps processing without holding every invoice's line items in memory at once.
+    executor = ThreadPoolExecutor(max_workers=8)
+    lookahead = 4
+    pendingPages = {}
+
+    def prefetch(index):
+        if index < len(invoiceList):
+            invoiceID, totalItems = invoiceList[index]['id'], invoiceList[index]['invoiceTopLevelItemCount']
+            if cacheDir == None or not os.path.exists(invoiceCacheFile(invoiceID)):
+                pendingPages[invoiceID] = [executor.submit(getInvoiceItems, invoiceID, limit, offset, totalItems)
+                                           for offset in range(0, totalItems, limit)]
+
+    try:
+        for index in range(lookahead):
+            prefetch(index)
+        for index, invoice in enumerate(invoiceList):
+            prefetch(index + lookahead)
+
+            invoiceID = invoice['id']
+            # To align to CFTS billing cutoffs display time in Dallas timezone.
+            invoiceDate = datetime.fromisoformat(invoice['createDate']).astimezone(DALLAS)
+            invoiceTotalAmount = float(invoice['invoiceTotalAmount'])
+            CFTSInvoiceDate = getCFTSInvoiceDate(invoiceDate.year, invoiceDate.month, invoiceDate.day)
+            invoiceDateStr = "{}-{:02d}-{:02d}".format(invoiceDate.year, invoiceDate.month, invoiceDate.day)
+
+            invoiceTotalRecurringAmount = float(invoice['invoiceTotalRecurringAmount'])
+            invoiceType = invoice['typeCode']
+            recurringDesc = ""
+            # every line item is in one of these service periods, format them and the invoice time once per invoice
+            invoiceTimeStr = invoiceDate.strftime("%H:%M:%S%z")
+            currentPeriod = _servicePeriod(invoiceDate)
+            hourlyPeriod = _servicePeriod(invoiceDate - _ONE_MONTH)
+            platformPeriod = _servicePeriod(invoiceDate - _TWO_MONTHS)
+            if invoiceType == "NEW":
+                serviceDates = currentPeriod
+
+            if invoiceType == "CREDIT" or invoiceType == "ONE-TIME-CHARGE":
+                serviceDates = (invoiceDateStr, invoiceDateStr)
+
+            totalItems = invoice['invoiceTopLevelItemCount']
+
+            # PRINT INVOICE SUMMARY LINE
+            logging.info('Invoice: {} Date: {} Type:{} Items: {} Amount: ${:,.2f}'.format(invoiceID, invoiceDateStr, invoiceType, totalItems, invoiceTotalRecurringAmount))
+
+            # Portal invoices do not change once issued, reuse rows cached by a previous run instead of fetching them again
+            if cacheDir != None:
+                cacheFile = invoiceCacheFile(invoiceID)
+                if invoiceID not in pendingPages:
+                    logging.info("Using cached line items for Invoice {} from {}.".format(invoiceID, cacheFile))
+                    with open(cacheFile, "rb") as f:
+                        rows.extend(pickle.load(f))
+                    continue
+            invoiceRows = len(rows)
+
+            # process pages in offset order as they complete
+            pages = (page.result() for page in pendingPages.pop(invoiceID))
+            for Billing_Invoice in pages:
+                # ITERATE THROUGH DETAIL
+                for item in Billing_Invoice:
+                    totalOneTimeAmount = float(item['totalOneTimeAmount'])
+                    billingItemId = item['billingItemId']
+                    category = item["categoryCode"]
+                    # category, memory, os and description values repeat across many rows, intern them so every row
+                    # references one shared string object
+                    categoryName = sys.intern(item["category"]["name"])
+                    description = item['product']['description']
+                    children = getChildren(item["children"])
+                    memory = sys.intern(getDescription("ram", children))
+                    operatingSystem = sys.intern(getDescription("os", children))
+
+                    if 'hostName' in item:
+                        if 'domainName' in item:
+                            hostName = item['hostName']+"."+item['domainName']
                         else:
-                            hours = 0
+                            hostName = item['hostName']
                     else:
-                        model = "Monthly"
-                    space = getStorageServiceUsage('performance_storage_space', item["children"])
-                    tier = getDescription("storage_tier_level", item["children"])
-                    snapshot = getDescription("storage_snapshot_space", item["children"])
-                    if space == "" or tier == "":
-                        description = model + " File Storage"
+                        hostName = ""
+
+                    recurringFee = float(item['totalRecurringAmount'])
+
+                    # If Hourly calculate hourly rate and total hours
+                    if item["hourlyFlag"]:
+                        # if hourly charges are previous month usage
+                        serviceDates = hourlyPeriod
+                        recurringDesc = "IaaS Usage"
+                        hourlyRecurringFee = 0
+                        if "hourlyRecurringFee" in item:
+                            if float(item["hourlyRecurringFee"]) > 0:
+                                hourlyRecurringFee = float(item['hourlyRecurringFee'])
+                                for child in item["children"]:
+                                    if "hourlyRecurringFee" in child:
+                                        hourlyRecurringFee = hourlyRecurringFee + float(child['hourlyRecurringFee'])
                     else:
-                        if snapshot == "":
-                            description = model + " File Storage "+ space + " at " + tier
-                        else:
-                            snapshotspace = getStorageServiceUsage('storage_snapshot_space', item["children"])
-                            description = model + " File Storage " + space + " at " + tier + " with " + snapshotspace
-                elif category == "guest_storage":
-                        imagestorage = getStorageServiceUsage("guest_storage_usage", item["children"])
-                        if imagestorage == "":
-                            description = description.replace('\n', " ")
+                        # Not an hourly billing item
+                        if categoryName.find("Platform Service Plan") != -1:
+                            # Non Hourly PaaS Usage from actual usage two months prior
+                            serviceDates = platformPeriod
+                            recurringDesc = "Platform Service Usage"
                         else:
-                            description = imagestorage
-                else:
-                    description = description.replace('\n', " ")
-
-
-                if invoiceType == "NEW":
-                    # calculate non pro-rated amount for use in forecast
-                    daysInMonth = monthrange(invoiceDate.year, invoiceDate.month)[1]
-                    daysLeft = daysInMonth - invoiceDate.day + 1
-                    dailyAmount = recurringFee / daysLeft
-                    NewEstimatedMonthly = dailyAmount * daysInMonth
-                # Append record to dataframe
-                row = {'Portal_Invoice_Date': invoiceDate.strftime("%Y-%m-%d"),
-                       'Portal_Invoice_Time': invoiceDate.strftime("%H:%M:%S%z"),
-                       'Service_Date_Start': serviceDateStart.strftime("%Y-%m-%d"),
-                       'Service_Date_End': serviceDateEnd.strftime("%Y-%m-%d"),
-                       'IBM_Invoice_Month': CFTSInvoiceDate,
-                       'Portal_Invoice_Number': invoiceID,
-                       'BillingItemId': billingItemId,
-                       'hostName': hostName,
-                       'Category': categoryName,
-                       'Description': description,
-                       'Memory': memory,
-                       'OS': os,
-                       'Hourly': item["hourlyFlag"],
-                       'Usage': item["usageChargeFlag"],
-                       'Hours': hours,
-                       'HourlyRate': round(hourlyRecurringFee,5),
-                       'totalRecurringCharge': round(recurringFee,3),
-                       'totalOneTimeAmount': float(totalOneTimeAmount),
-                       'NewEstimatedMonthly': float(NewEstimatedMonthly),
-                       'InvoiceTotal': float(invoiceTotalAmount),
-                       'InvoiceRecurring': float(invoiceTotalRecurringAmount),
-                       'Type': invoiceType,
-                       'Recurring_Description': recurringDesc
-                        }
-
-                df = df.append(row, ignore_index=True)
+                            if invoiceType == "RECURRING":
+                                serviceDates = currentPeriod
+                                recurringDesc = "IaaS Monthly"
+                        hourlyRecurringFee = 0
+
+                    # Special handling for storage
+                    if category in DESCRIPTION_BUILDERS:
+                        description = DESCRIPTION_BUILDERS[category](item, children, description)
+                        if category == "storage_as_a_service" and item["hourlyFlag"]:
+                            for child in item["children"]:
+                                if "hourlyRecurringFee" in child:
+                                    hourlyRecurringFee = hourlyRecurringFee + float(child['hourlyRecurringFee'])
+
+                    # Append record as a tuple in columns order, rows are only read back by DataFrame.from_records
+                    row = (invoiceDateStr,                      # Portal_Invoice_Date
+                           invoiceTimeStr,                      # Portal_Invoice_Time
+                           serviceDates[0],                     # Service_Date_Start
+                           serviceDates[1],                     # Service_Date_End
+                           CFTSInvoiceDate,                     # IBM_Invoice_Month
+                           invoiceID,                           # Portal_Invoice_Number
+                           invoiceType,                         # Type
+                           billingItemId,                       # BillingItemId
+                           hostName,                            # hostName
+                           categoryName,                        # Category
+                           sys.intern(description),             # Description
+                           memory,                              # Memory
+                           operatingSystem,                     # OS
+                           item["hourlyFlag"],                  # Hourly
+                           item["usageChargeFlag"],             # Usage
+                           0,                                   # Hours
+                           hourlyRecurringFee,                  # HourlyRate
+                           round(recurringFee,3),               # totalRecurringCharge
+                           # pro-rated amount for NEW invoices, scaled to a full month after the loop
+                           recurringFee if invoiceType == "NEW" else 0.0,  # NewEstimatedMonthly
+                           totalOneTimeAmount,                  # totalOneTimeAmount
+                           invoiceTotalAmount,                  # InvoiceTotal
+                           invoiceTotalRecurringAmount,         # InvoiceRecurring
+                           recurringDesc)                       # Recurring_Description
+
+                    rows.append(row)
+
+            if cacheDir != None:
+                # write to a temporary file first so an interrupted run never leaves a partial invoice in the cache
+                with open(cacheFile + ".tmp", "wb") as f:
+                    pickle.dump(rows[invoiceRows:], f)
+                os.replace(cacheFile + ".tmp", cacheFile)
+    except SoftLayer.SoftLayerAPIError:
+        # a page could not be retrieved after retrying, getInvoiceItems has logged the fault
+        sys.exit(1)
+    finally:
+        # drop prefetches still queued when leaving early, rather than fetching invoices that will never be used
+        executor.shutdown(cancel_futures=True)
+
+    df = pd.DataFrame.from_records(rows, columns=columns)
+    # release the row tuples now rather than at return, so they are not held alongside the dataframe while it is
+    # post processed
+    del rows
+    df["Description"] = df["Description"].str.replace("\n", " ", regex=False)
+
+    # Calculate total hours for hourly items from the summed hourly rate for all line items at once
+    hourlyRate = df["HourlyRate"].astype(float)
+    recurringCharge = df["totalRecurringCharge"].astype(float)
+    df["Hours"] = np.where(hourlyRate > 0, np.round(recurringCharge / hourlyRate.where(hourlyRate > 0, 1)), 0).astype(int)
+    df["HourlyRate"] = hourlyRate.round(5)
+
+    # calculate non pro-rated amount of NEW invoices for use in forecast from the invoice day within its month
+    invoiceDay = pd.to_datetime(df["Portal_Invoice_Date"]).values.astype("datetime64[D]")
+    monthStart = invoiceDay.astype("datetime64[M]")
+    daysInMonth = ((monthStart + 1).astype("datetime64[D]") - monthStart.astype("datetime64[D]")).astype(int)
+    daysLeft = daysInMonth - (invoiceDay - monthStart.astype("datetime64[D]")).astype(int)
+    new = (df["Type"] == "NEW").values
+    df.loc[new, "NewEstimatedMonthly"] = df["NewEstimatedMonthly"].values[new] / daysLeft[new] * daysInMonth[new]
     return df
 
+def writeSheet(writer, df, sheetname, columnFormats=()):
+    # Write dataframe to a new worksheet one row at a time.  In constant_memory mode xlsxwriter flushes each row as soon
+    # as a later row is written, so cells must be written in row order (df.to_excel writes column by column).  Column
+    # widths and formats are (range, width, format) tuples, set before any row is written because a flushed row keeps
+    # the column formats in effect when it was written.
+    workbook = writer.book
+    worksheet = workbook.add_worksheet(sheetname)
+    for columnRange, width, columnFormat in columnFormats:
+        worksheet.set_column(columnRange, width, columnFormat)
+    header = workbook.add_format({'bold': True, 'border': 1, 'align': 'center'})
+    indexlevels = df.index.nlevels
+    row = 0
+    if df.columns.nlevels > 1:
+        # one header row per column level followed by the index names
+        for level in range(df.columns.nlevels):
+            worksheet.write_row(row, indexlevels - 1, [df.columns.names[level]] + list(df.columns.get_level_values(level)), header)
+            row += 1
+        worksheet.write_row(row, 0, list(df.index.names), header)
+        row += 1
+    else:
+        worksheet.write_row(row, 0, list(df.index.names) + list(df.columns), header)
+        row += 1
+    # stream rows straight from the columns, only columns containing nulls are copied to blank them out
+    columns = [df.iloc[:, i].astype(object).fillna("") if hasnull else df.iloc[:, i] for i, hasnull in enumerate(df.isnull().any())]
+    # index labels use the header format like df.to_excel
+    for index, values in zip(df.index, zip(*columns)):
+        if indexlevels == 1:
+            index = (index,)
+        worksheet.write_row(row, 0, index, header)
+        worksheet.write_row(row, indexlevels, values)
+        row += 1
+    return worksheet
+
+def sumPivot(df, index, values, columns, margins_name="Total"):
+    # Equivalent of pivot_table(aggfunc=sum, margins=True, fill_value=0) for a single value column.  Keys are factorized
+    # to integer codes and every cell is summed in one compiled np.bincount pass instead of a groupby per pivot.
+    rowCodes = np.zeros(len(df), dtype=np.int64)
+    valid = np.ones(len(df), dtype=bool)
+    levels = []
+    for key in index:
+        codes, uniques = pd.factorize(df[key], sort=True)
+        rowCodes = rowCodes * len(uniques) + codes
+        valid &= codes >= 0
+        levels.append(uniques)
+    colCodes, colKeys = pd.factorize(df[columns], sort=True)
+    valid &= colCodes >= 0
+    rowCodes, rowKeys = pd.factorize(rowCodes[valid], sort=True)
+    colCodes = colCodes[valid]
+
+    nrows, ncols = len(rowKeys), len(colKeys)
+    sums = np.bincount(rowCodes * ncols + colCodes, weights=df[values].to_numpy(dtype=float)[valid],
+                       minlength=nrows * ncols).reshape(nrows, ncols)
+    sums = np.column_stack([sums, sums.sum(axis=1)])
+    sums = np.vstack([sums, sums.sum(axis=0)])
+
+    positions = np.unravel_index(rowKeys, [len(uniques) for uniques in levels])
+    if len(index) > 1:
+        rows = pd.MultiIndex.from_tuples(list(zip(*[levels[i][positions[i]] for i in range(len(index))])) +
+                                         [(margins_name,) + ("",) * (len(index) - 1)], names=index)
+    else:
+        rows = pd.Index(list(levels[0][positions[0]]) + [margins_name], name=index[0])
+    cols = pd.MultiIndex.from_product([[values], list(colKeys) + [margins_name]], names=[None, columns])
+    return pd.DataFrame(sums, index=rows, columns=cols)
+
 def createReport(filename, classicUsage, paasUsage):
     # Write dataframe to excel
     logging.info("Creating Pivots File.")
-    writer = pd.ExcelWriter(filename, engine='xlsxwriter')
+    # constant_memory caps memory at one row per sheet regardless of Detail size, all sheets are written by writeSheet.
+    # Cells are written as their column types, so skip xlsxwriter's per string number/formula/url checks.
+    writer = pd.ExcelWriter(filename, engine='xlsxwriter', engine_kwargs={'options': {'constant_memory': True,
+                                                                                        'strings_to_numbers': False,
+                                                                                        'strings_to_formulas': False,
+                                                                                        'strings_to_urls': False}})
     workbook = writer.book
 
     #
     # Write detail tab
     #
-    classicUsage.to_excel(writer, 'Detail')
     usdollar = workbook.add_format({'num_format': '$#,##0.00'})
-    worksheet = writer.sheets['Detail']
-    worksheet.set_column('Q:W', 18, usdollar)
+    worksheet = writeSheet(writer, classicUsage, 'Detail', [('Q:W', 18, usdollar)])
     totalrows,totalcols=classicUsage.shape
     worksheet.autofilter(0,0,totalrows,totalcols)
 
@@ -366,27 +530,44 @@ def createReport(filename, classicUsage, paasUsage):
     # Map Portal Invoices to SLIC Invoices / Create Top Sheet per SLIC month
     #
 
-    classicUsage["totalAmount"] = classicUsage["totalOneTimeAmount"] + classicUsage["totalRecurringCharge"]
-
-    months = classicUsage.IBM_Invoice_Month.unique()
-    for i in months:
+    # Slice the key and value columns used by the top sheets and pivots once, so each query and pivot below works on a
+    # narrow frame instead of copying and hashing every detail column.
+    pivotBase = classicUsage[["IBM_Invoice_Month", "Type", "Category", "Description", "OS", "Hourly",
+                              "Portal_Invoice_Number", "Portal_Invoice_Date", "Service_Date_Start", "Service_Date_End",
+                              "Recurring_Description", "Hours", "totalRecurringCharge", "NewEstimatedMonthly"]].\
+                              assign(totalAmount=classicUsage["totalOneTimeAmount"] + classicUsage["totalRecurringCharge"])
+    # Group keys are low cardinality, as categoricals the groupbys and pivots below hash integer codes instead of strings.
+    # observed=True keeps category combinations that never occur out of the results, ordered categories keep the observed
+    # groups in sorted order like the string keys were.
+    for column in ["IBM_Invoice_Month", "Type", "Category", "Description", "OS", "Recurring_Description"]:
+        pivotBase[column] = pivotBase[column].astype(pd.CategoricalDtype(ordered=True))
+
+    # partition by IBM invoice month in one pass, groups come back in order of first appearance like unique()
+    months = []
+    for i, ibminvoicemonth in pivotBase.groupby('IBM_Invoice_Month', sort=False, observed=True):
+        months.append(i)
         logging.info("Creating top sheet for %s." % (i))
-        ibminvoicemonth = classicUsage.query('IBM_Invoice_Month == @i')
         SLICInvoice = pd.pivot_table(ibminvoicemonth,
                                      index=["Type", "Portal_Invoice_Number", "Service_Date_Start", "Service_Date_End", "Recurring_Description"],
                                      values=["totalAmount"],
-                                     aggfunc={'totalAmount': np.sum}, fill_value=0).sort_values(by=['Service_Date_Start', "Portal_Invoice_Number"])
-
-        out = pd.concat([d.append(d.sum().rename((k, ' ', ' ', 'Subtotal', ' '))) for k, d in SLICInvoice.groupby('Type')]).append(SLICInvoice.sum().rename((' ', ' ', ' ', 'Pay this Amount', '')))
+                                     aggfunc='sum', fill_value=0, observed=True).sort_values(by=['Service_Date_Start', "Portal_Invoice_Number"])
+
+        # Subtotal each invoice type in one groupby, then stable sort on Type so each subtotal follows its own invoices
+        subtotals = SLICInvoice.groupby(level="Type", observed=True).sum()
+        subtotals.index = pd.MultiIndex.from_tuples([(k, ' ', ' ', 'Subtotal', ' ') for k in subtotals.index], names=SLICInvoice.index.names)
+        out = pd.concat([SLICInvoice, subtotals])
+        out = out.iloc[np.argsort(out.index.get_level_values("Type"), kind="stable")]
+        # the grand total is the sum of the few subtotal rows rather than another pass over every invoice row
+        grandtotal = subtotals.sum().to_frame().T
+        grandtotal.index = pd.MultiIndex.from_tuples([(' ', ' ', ' ', 'Pay this Amount', '')], names=SLICInvoice.index.names)
+        out = pd.concat([out, grandtotal])
         out.rename(columns={"Type": "Invoice Type", "Portal_Invoice_Number": "Invoice",
                             "Service_Date_Start": "Service Start", "Service_Date_End": "Service End",
                              "Recurring_Description": "Description", "totalAmount": "Amount"}, inplace=True)
-        out.to_excel(writer, 'TopSheet-{}'.format(i))
-        worksheet = writer.sheets['TopSheet-{}'.format(i)]
         format1 = workbook.add_format({'num_format': '$#,##0.00'})
         format2 = workbook.add_format({'align': 'left'})
-        worksheet.set_column("A:E", 20, format2)
-        worksheet.set_column("F:F", 18, format1)
+        worksheet = writeSheet(writer, out, 'TopSheet-{}'.format(i), [("A:E", 20, format2),
+                                                                      ("F:F", 18, format1)])
 
     #
     # Build a pivot table by for Forecasting NEW invoices form 1st to 20th and add to last Recurring Invoice to estimate
@@ -395,199 +576,184 @@ def createReport(filename, classicUsage, paasUsage):
     invoicemonth = months[-1]
     newstart = invoicemonth + "-01"
     newend = invoicemonth + "-19"
-    forecastR = classicUsage.query('IBM_Invoice_Month == @invoicemonth and Type == "RECURRING"')[['Portal_Invoice_Date', 'IBM_Invoice_Month','Type','Category','totalAmount']]
-    forecastN = classicUsage.query('IBM_Invoice_Month == @invoicemonth and Type == "NEW" and Portal_Invoice_Date >= @newstart and Portal_Invoice_Date <= @newend ')[['Portal_Invoice_Date', 'IBM_Invoice_Month','Type','Category','NewEstimatedMonthly']]
-    result = forecastR.append(forecastN).fillna(0)
+    forecastR = pivotBase.query('IBM_Invoice_Month == @invoicemonth and Type == "RECURRING"')[['Portal_Invoice_Date', 'IBM_Invoice_Month','Type','Category','totalAmount']]
+    forecastN = pivotBase.query('IBM_Invoice_Month == @invoicemonth and Type == "NEW" and Portal_Invoice_Date >= @newstart and Portal_Invoice_Date <= @newend ')[['Portal_Invoice_Date', 'IBM_Invoice_Month','Type','Category','NewEstimatedMonthly']]
+    result = forecastR.append(forecastN).fillna({"totalAmount": 0, "NewEstimatedMonthly": 0})
     sum_column = result["totalAmount"] + result["NewEstimatedMonthly"]
     result["nextRecurring"] = sum_column
     if len(result) > 0:
         newForecast = pd.pivot_table(result, index=["Category"],
                                             values=["totalAmount", "NewEstimatedMonthly", "nextRecurring"],
-                                            aggfunc={'totalAmount': np.sum, 'NewEstimatedMonthly': np.sum, 'nextRecurring': np.sum }, margins=True, margins_name='Total', fill_value=0). \
+                                            aggfunc='sum', margins=True, margins_name='Total', fill_value=0, observed=True). \
                                             rename(columns={'totalAmount': 'lastRecurringInvoice', 'NewEstimatedMonthly': 'NewEstimatedCharges'})
 
         column_order = ['lastRecurringInvoice', 'NewEstimatedCharges', 'nextRecurring']
         newForecast = newForecast.reindex(column_order, axis=1)
-        newForecast.to_excel(writer, 'recurringForecast')
-        worksheet = writer.sheets['recurringForecast']
         format1 = workbook.add_format({'num_format': '$#,##0.00'})
         format2 = workbook.add_format({'align': 'left'})
-        worksheet.set_column("A:A", 40, format2)
-        worksheet.set_column("B:D", 25, format1)
+        worksheet = writeSheet(writer, newForecast, 'recurringForecast', [("A:A", 40, format2),
+                                                                          ("B:D", 25, format1)])
 
     #
     # Build a pivot table by Invoice Type
     #
-    if len(classicUsage)>0:
-        invoiceSummary = pd.pivot_table(classicUsage, index=["Type", "Category"],
+    if len(pivotBase)>0:
+        invoiceSummary = pd.pivot_table(pivotBase, index=["Type", "Category"],
                                         values=["totalAmount"],
                                         columns=['IBM_Invoice_Month'],
-                                        aggfunc={'totalAmount': np.sum,}, margins=True, margins_name="Total", fill_value=0).\
+                                        aggfunc='sum', margins=True, margins_name="Total", fill_value=0, observed=True).\
                                         rename(columns={'totalRecurringCharge': 'TotalRecurring'})
-        invoiceSummary.to_excel(writer, 'InvoiceSummary')
-        worksheet = writer.sheets['InvoiceSummary']
         format1 = workbook.add_format({'num_format': '$#,##0.00'})
         format2 = workbook.add_format({'align': 'left'})
-        worksheet.set_column("A:A", 20, format2)
-        worksheet.set_column("B:B", 40, format2)
-        worksheet.set_column("C:ZZ", 18, format1)
+        worksheet = writeSheet(writer, invoiceSummary, 'InvoiceSummary', [("A:A", 20, format2),
+                                                                          ("B:B", 40, format2),
+                                                                          ("C:ZZ", 18, format1)])
 
 
     #
     # Build a pivot table by Category with totalRecurringCharges
 
-    if len(classicUsage)>0:
-        categorySummary = pd.pivot_table(classicUsage, index=["Type", "Category", "Description"],
+    if len(pivotBase)>0:
+        categorySummary = pd.pivot_table(pivotBase, index=["Type", "Category", "Description"],
                                          values=["totalAmount"],
                                          columns=['IBM_Invoice_Month'],
-                                         aggfunc={'totalAmount': np.sum}, margins=True, margins_name="Total", fill_value=0)
-        categorySummary.to_excel(writer, 'CategorySummary')
-        worksheet = writer.sheets['CategorySummary']
+                                         aggfunc='sum', margins=True, margins_name="Total", fill_value=0, observed=True)
         format1 = workbook.add_format({'num_format': '$#,##0.00'})
         format2 = workbook.add_format({'align': 'left'})
-        worksheet.set_column("A:A", 40, format2)
-        worksheet.set_column("B:B", 40, format2)
-        worksheet.set_column("C:ZZ", 18, format1)
+        worksheet = writeSheet(writer, categorySummary, 'CategorySummary', [("A:A", 40, format2),
+                                                                            ("B:B", 40, format2),
+                                                                            ("C:ZZ", 18, format1)])
+
+    #
+    # Split line items by Category and Hourly once for the server pivots below
+    #
+    categoryHourly = pivotBase.groupby(["Category", "Hourly"], sort=False, observed=True)
+
+    def getServers(category, hourly):
+        try:
+            return categoryHourly.get_group((category, hourly))
+        except KeyError:
+            return pivotBase.iloc[:0]
 
     #
     # Build a pivot table for Hourly VSI's with totalRecurringCharges
     #
-    virtualServers = classicUsage.query('Category == ["Computing Instance"] and Hourly == [True]')
+    virtualServers = getServers("Computing Instance", True)
     if len(virtualServers) > 0:
         virtualServerPivot = pd.pivot_table(virtualServers, index=["Description", "OS"],
                                 values=["Hours", "totalRecurringCharge"],
                                 columns=['IBM_Invoice_Month'],
-                                aggfunc={'Description': len, 'Hours': np.sum, 'totalRecurringCharge': np.sum}, fill_value=0).\
+                                aggfunc={'Description': 'size', 'Hours': 'sum', 'totalRecurringCharge': 'sum'}, fill_value=0, observed=True).\
                                         rename(columns={"Description": 'qty', 'Hours': 'Total Hours', 'totalRecurringCharge': 'TotalRecurring'})
-        virtualServerPivot.to_excel(writer, 'HrlyVirtualServerPivot')
-        worksheet = writer.sheets['HrlyVirtualServerPivot']
+        worksheet = writeSheet(writer, virtualServerPivot, 'HrlyVirtualServerPivot')
 
     #
     # Build a pivot table for Monthly VSI's with totalRecurringCharges
     #
-    monthlyVirtualServers = classicUsage.query('Category == ["Computing Instance"] and Hourly == [False]')
+    monthlyVirtualServers = getServers("Computing Instance", False)
     if len(monthlyVirtualServers) > 0:
         virtualServerPivot = pd.pivot_table(monthlyVirtualServers, index=["Description", "OS"],
                                 values=["totalRecurringCharge"],
                                 columns=['IBM_Invoice_Month'],
-                                aggfunc={'Description': len, 'totalRecurringCharge': np.sum}, fill_value=0).\
+                                aggfunc={'Description': 'size', 'totalRecurringCharge': 'sum'}, fill_value=0, observed=True).\
                                         rename(columns={"Description": 'qty', 'totalRecurringCharge': 'TotalRecurring'})
-        virtualServerPivot.to_excel(writer, 'MnthlyVirtualServerPivot')
-        worksheet = writer.sheets['MnthlyVirtualServerPivot']
+        worksheet = writeSheet(writer, virtualServerPivot, 'MnthlyVirtualServerPivot')
 
 
     #
     # Build a pivot table for Hourly Bare Metal with totalRecurringCharges
     #
-    bareMetalServers = classicUsage.query('Category == ["Server"]and Hourly == [True]')
+    bareMetalServers = getServers("Server", True)
     if len(bareMetalServers) > 0:
         bareMetalServerPivot = pd.pivot_table(bareMetalServers, index=["Description", "OS"],
                                 values=["Hours", "totalRecurringCharge"],
                                 columns=['IBM_Invoice_Month'],
-                                aggfunc={'Description': len,  'totalRecurringCharge': np.sum}, fill_value=0).\
-                                        rename(columns={"Description": 'qty', 'Hours': np.sum, 'totalRecurringCharge': 'TotalRecurring'})
-        bareMetalServerPivot.to_excel(writer, 'HrlyBaremetalServerPivot')
-        worksheet = writer.sheets['HrlyBaremetalServerPivot']
+                                aggfunc={'Description': 'size', 'totalRecurringCharge': 'sum'}, fill_value=0, observed=True).\
+                                        rename(columns={"Description": 'qty', 'Hours': 'Total Hours', 'totalRecurringCharge': 'TotalRecurring'})
+        worksheet = writeSheet(writer, bareMetalServerPivot, 'HrlyBaremetalServerPivot')
 
     #
     # Build a pivot table for Monthly Bare Metal with totalRecurringCharges
     #
-    monthlyBareMetalServers = classicUsage.query('Category == ["Server"] and Hourly == [False]')
+    monthlyBareMetalServers = getServers("Server", False)
     if len(monthlyBareMetalServers) > 0:
         monthlyBareMetalServerPivot = pd.pivot_table(monthlyBareMetalServers, index=["Description", "OS"],
                                 values=["totalRecurringCharge"],
                                 columns=['IBM_Invoice_Month'],
-                                aggfunc={'Description': len,  'totalRecurringCharge': np.sum}, fill_value=0).\
+                                aggfunc={'Description': 'size', 'totalRecurringCharge': 'sum'}, fill_value=0, observed=True).\
                                         rename(columns={"Description": 'qty', 'totalRecurringCharge': 'TotalRecurring'})
-        monthlyBareMetalServerPivot.to_excel(writer, 'MthlyBaremetalServerPivot')
-        worksheet = writer.sheets['MthlyBaremetalServerPivot']
         format1 = workbook.add_format({'num_format': '$#,##0.00'})
         format2 = workbook.add_format({'align': 'left'})
-        worksheet.set_column("A:A", 40, format2)
-        worksheet.set_column("B:B", 40, format2)
+        worksheet = writeSheet(writer, monthlyBareMetalServerPivot, 'MthlyBaremetalServerPivot', [("A:A", 40, format2),
+                                                                                                  ("B:B", 40, format2)])
 
   # IF PaaS credential included add usage reports
     if len(paasUsage) >0:
-        paasUsage.to_excel(writer, "PaaS_Usage")
-        worksheet = writer.sheets['PaaS_Usage']
         format1 = workbook.add_format({'num_format': '$#,##0.00'})
         format2 = workbook.add_format({'align': 'left'})
-        worksheet.set_column("A:C", 12, format2)
-        worksheet.set_column("D:E", 25, format2)
-        worksheet.set_column("F:G", 18, format1)
-        worksheet.set_column("H:I", 25, format2)
-        worksheet.set_column("J:J", 18, format1)
-
-        paasSummary = pd.pivot_table(paasUsage, index=["resource_name"],
-                                        values=["charges"],
-                                        columns=["invoiceMonth"],
-                                        aggfunc={'charges': np.sum, }, margins=True, margins_name="Total",
-                                        fill_value=0)
-        paasSummary.to_excel(writer, 'PaaS_Summary')
-        worksheet = writer.sheets['PaaS_Summary']
+        worksheet = writeSheet(writer, paasUsage, "PaaS_Usage", [("A:C", 12, format2),
+                                                                 ("D:E", 25, format2),
+                                                                 ("F:G", 18, format1),
+                                                                 ("H:I", 25, format2),
+                                                                 ("J:J", 18, format1)])
+
+        paasSummary = sumPivot(paasUsage, index=["resource_name"], values="charges", columns="invoiceMonth")
         format1 = workbook.add_format({'num_format': '$#,##0.00'})
         format2 = workbook.add_format({'align': 'left'})
-        worksheet.set_column("A:A", 35, format2)
-        worksheet.set_column("B:ZZ", 18, format1)
-
-        paasSummaryPlan = pd.pivot_table(paasUsage, index=["resource_name", "plan_name"],
-                                     values=["charges"],
-                                     columns=["invoiceMonth"],
-                                     aggfunc={'charges': np.sum, }, margins=True, margins_name="Total",
-                                     fill_value=0)
-        paasSummaryPlan.to_excel(writer, 'PaaS_Plan_Summary')
-        worksheet = writer.sheets['PaaS_Plan_Summary']
+        worksheet = writeSheet(writer, paasSummary, 'PaaS_Summary', [("A:A", 35, format2),
+                                                                     ("B:ZZ", 18, format1)])
+
+        paasSummaryPlan = sumPivot(paasUsage, index=["resource_name", "plan_name"], values="charges", columns="invoiceMonth")
         format1 = workbook.add_format({'num_format': '$#,##0.00'})
         format2 = workbook.add_format({'align': 'left'})
-        worksheet.set_column("A:B", 35, format2)
-        worksheet.set_column("C:ZZ", 18, format1)
+        worksheet = writeSheet(writer, paasSummaryPlan, 'PaaS_Plan_Summary', [("A:B", 35, format2),
+                                                                              ("C:ZZ", 18, format1)])
 
     writer.save()
 
-def multi_part_upload(bucket_name, item_name, file_path):
+def multi_part_upload(bucket_name, item_name, file_data):
+    # uses the cos resource, ibm_boto3 and ClientError set up by the COS branch of main
     try:
         logging.info("Starting file transfer for {0} to bucket: {1}".format(item_name, bucket_name))
-        # set 5 MB chunks
-        part_size = 1024 * 1024 * 5
+        # set 64 MB chunks
+        part_size = 1024 * 1024 * 64
 
-        # set threadhold to 15 MB
-        file_threshold = 1024 * 1024 * 15
+        # set threadhold to 64 MB
+        file_threshold = 1024 * 1024 * 64
 
-        # set the transfer threshold and chunk size
+        # set the transfer threshold, chunk size and number of parts uploaded in parallel
         transfer_config = ibm_boto3.s3.transfer.TransferConfig(
             multipart_threshold=file_threshold,
-            multipart_chunksize=part_size
+            multipart_chunksize=part_size,
+            max_concurrency=10,
+            use_threads=True
         )
 
         # the upload_fileobj method will automatically execute a multi-part upload
-        # in 5 MB chunks for all files over 15 MB
-        with open(file_path, "rb") as file_data:
-            cos.Object(bucket_name, item_name).upload_fileobj(
-                Fileobj=file_data,
-                Config=transfer_config
-            )
+        # in 64 MB chunks, 10 at a time, for all files over 64 MB
+        file_data.seek(0)
+        cos.Object(bucket_name, item_name).upload_fileobj(
+            Fileobj=file_data,
+            Config=transfer_config
+        )
         logging.info("Transfer for {0} complete".format(item_name))
     except ClientError as be:
         logging.error("CLIENT ERROR: {0}".format(be))
     except Exception as e:
         logging.error("Unable to complete multi-part upload: {0}".format(e))
 
-def getAccountId(IC_API_KEY):
+def getAccountId(authenticator, IC_API_KEY):
     ##########################################################
     ## Get Account from the passed API Key
     ##########################################################
 
     logging.info("Retrieving IBM Cloud Account ID for this ApiKey.")
-    try:
-        authenticator = IAMAuthenticator(IC_API_KEY)
-    except ApiException as e:
-        logging.error("API exception {}.".format(str(e)))
-        quit()
     try:
         iam_identity_service = IamIdentityV1(authenticator=authenticator)
     except ApiException as e:
         logging.error("API exception {}.".format(str(e)))
-        quit()
+        logging.error("API status code {}.".format(e.code))
+        sys.exit(1)
 
     try:
         api_key = iam_identity_service.get_api_keys_details(
@@ -595,11 +761,12 @@ def getAccountId(IC_API_KEY):
         ).get_result()
     except ApiException as e:
         logging.error("API exception {}.".format(str(e)))
-        quit()
+        logging.error("API status code {}.".format(e.code))
+        sys.exit(1)
 
     return api_key["account_id"]
 
-def sendEmail(startdate, enddate, sendGridTo, sendGridFrom, sendGridSubject, sendGridApi, outputname):
+def sendEmail(startdate, enddate, sendGridTo, sendGridFrom, sendGridSubject, sendGridApi, outputname, report):
     # Send output to email distributionlist via SendGrid
 
     html = ("<p><b>invoiceAnalysis Output Attached for {} to {} </b></br></p>".format(datetime.strftime(startdate, "%m/%d/%Y"), datetime.strftime(enddate, "%m/%d/%Y")))
@@ -616,12 +783,8 @@ def sendEmail(startdate, enddate, sendGridTo, sendGridFrom, sendGridSubject, sen
 
     message.add_personalization(to_list)
 
-    # create attachment from file
-    file_path = os.path.join("./", outputname)
-    with open(file_path, 'rb') as f:
-        data = f.read()
-        f.close()
-    encoded = base64.b64encode(data).decode()
+    # create attachment from in memory report
+    encoded = base64.b64encode(report.getvalue()).decode()
     attachment = Attachment()
     attachment.file_content = FileContent(encoded)
     attachment.file_type = FileType('application/xlsx')
@@ -637,43 +800,90 @@ def sendEmail(startdate, enddate, sendGridTo, sendGridFrom, sendGridSubject, sen
         logging.error("Email Send Error, status code = %s." % e.to_dict)
     return
 
-def accountUsage(IC_API_KEY, IC_ACCOUNT_ID, startdate, enddate):
+# Columns of dataframe for PaaS usage.  Month, resource, plan and unit names repeat on every usage record, as categoricals
+# they are stored once with a small integer code per row.
+PAAS_COLS = ('usageMonth',
+             'invoiceMonth',
+             'resource_name',
+             'plan_name',
+             'billable_charges',
+             'non_billable_charges',
+             'unit',
+             'quantity',
+             'charges')
+PAAS_DTYPES = {'usageMonth': 'category',
+               'invoiceMonth': 'category',
+               'resource_name': 'category',
+               'plan_name': 'category',
+               'billable_charges': 'float64',
+               'non_billable_charges': 'float64',
+               'unit': 'category',
+               'quantity': 'float64',
+               'charges': 'float64'}
+
+def _iterUsageRows(usage, usageMonth, recurringMonth):
+    # flatten one month of resources -> plans -> usage into PAAS_COLS ordered tuples, reading each resource and plan
+    # field once rather than once per usage record and skipping resources and plans without usage records
+    for u in usage['resources']:
+        plans = u.get('plans') or ()
+        if not plans:
+            continue
+        resourceName, billableCost, nonBillableCost = u['resource_name'], u['billable_cost'], u['non_billable_cost']
+        for p in plans:
+            planUsage = p.get('usage') or ()
+            if not planUsage:
+                continue
+            planName = p['plan_name']
+            for x in planUsage:
+                yield (usageMonth, recurringMonth, resourceName, planName, billableCost, nonBillableCost,
+                       x['unit'], x['quantity'], x['cost'])
+
+def accountUsage(authenticator, IC_ACCOUNT_ID, startdate, enddate, cacheDir=None):
     ##########################################################
     ## Get Usage for Account matching recuring invoice periods
     ##########################################################
 
-    accountUsage = pd.DataFrame(columns=['usageMonth',
-                               'invoiceMonth',
-                               'resource_name',
-                               'plan_name',
-                               'billable_charges',
-                               'non_billable_charges',
-                               'unit',
-                               'quantity',
-                               'charges']
-                                )
-
-    try:
-        authenticator = IAMAuthenticator(IC_API_KEY)
-    except ApiException as e:
-        logging.error("API exception {}.".format(str(e)))
-        error = ("API exception {}.".format(str(e)))
-        return accountUsage, error
     try:
         usage_reports_service = UsageReportsV4(authenticator=authenticator)
     except ApiException as e:
         logging.error("API exception {}.".format(str(e)))
-        error = ("API exception {}.".format(str(e)))
-        return accountUsage, error
+        logging.error("API status code {}.".format(e.code))
+        sys.exit(1)
 
     # PaaS consumption is delayed by one recurring invoice (ie April usage on June 1 recurring invoice)
     paasStart = startdate - relativedelta(months=1)
     paasEnd = enddate - relativedelta(months=2)
-
+    usageMonths = []
     while paasStart <= paasEnd + relativedelta(days=1):
-        usageMonth = paasStart.strftime('%Y-%m')
         recurringMonth = paasStart + relativedelta(months=2)
-        recurringMonth = recurringMonth.strftime('%Y-%m')
+        usageMonths.append(("{}-{:02d}".format(paasStart.year, paasStart.month), "{}-{:02d}".format(recurringMonth.year, recurringMonth.month)))
+        paasStart += relativedelta(months=1)
+
+    # A month's usage is final once the recurring invoice it is billed on has been issued, those months are kept in a
+    # shelve in cacheDir so later runs only request usage for months that are still open.
+    thisMonth = datetime.now(DALLAS).strftime("%Y-%m")
+    cachedUsage = {}
+    closedUsage = {}
+    if cacheDir != None:
+        with shelve.open(os.path.join(cacheDir, "usage")) as cache:
+            for usageMonth, recurringMonth in usageMonths:
+                key = "{}/{}".format(IC_ACCOUNT_ID, usageMonth)
+                if key in cache:
+                    cachedUsage[usageMonth] = cache[key]
+
+    # fetch up to 8 months at a time, and size the connection pool to match so each worker keeps its connection open
+    # between calls.  Throttled or failed requests are retried with backoff, and time out rather than hang a worker.
+    # Once retries run out the last response is returned, so the SDK still raises it as an ApiException.
+    workers = min(max(len(usageMonths), 1), 8)
+    retries = Retry(total=5, backoff_factor=0.5, status_forcelist=[429, 500, 502, 503, 504], allowed_methods=frozenset(["GET"]),
+                    raise_on_status=False)
+    usage_reports_service.http_client.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=workers, max_retries=retries))
+    usage_reports_service.set_http_config({'timeout': (5, 60)})
+
+    def getUsage(usageMonth):
+        if usageMonth in cachedUsage:
+            logging.info("Using cached PaaS Usage from {}.".format(usageMonth))
+            return cachedUsage[usageMonth]
         logging.info("Retrieving PaaS Usage from {}.".format(usageMonth))
         try:
             usage = usage_reports_service.get_account_usage(
@@ -683,23 +893,27 @@ def accountUsage(IC_API_KEY, IC_ACCOUNT_ID, startdate, enddate):
             ).get_result()
         except ApiException as e:
             logging.error("API exception {}.".format(str(e)))
-            quit()
-        paasStart += relativedelta(months=1)
-        for u in usage['resources']:
-            for p in u['plans']:
-                for x in p['usage']:
-                    row = {
-                        'usageMonth': usageMonth,
-                        'invoiceMonth': recurringMonth,
-                        'resource_name': u['resource_name'],
-                        'billable_charges': u["billable_cost"],
-                        'non_billable_charges': u["non_billable_cost"],
-                        'plan_name': p["plan_name"],
-                        'unit': x["unit"],
-                        'quantity': x["quantity"],
-                        'charges': x["cost"],
-                    }
-                    accountUsage = accountUsage.append(row, ignore_index=True)
+            logging.error("API status code {}.".format(e.code))
+            sys.exit(1)
+        except requests.exceptions.RequestException as e:
+            logging.error("Usage request for {} failed {}.".format(usageMonth, str(e)))
+            sys.exit(1)
+        return usage
+
+    def usageRows():
+        # yield one row per usage record so the dataframe is built in a single pass, months are independent requests
+        # so they are fetched concurrently and processed in month order as they complete
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            usageReports = executor.map(getUsage, [usageMonth for usageMonth, recurringMonth in usageMonths])
+            for (usageMonth, recurringMonth), usage in zip(usageMonths, usageReports):
+                if cacheDir != None and recurringMonth <= thisMonth and usageMonth not in cachedUsage:
+                    closedUsage["{}/{}".format(IC_ACCOUNT_ID, usageMonth)] = usage
+                yield from _iterUsageRows(usage, usageMonth, recurringMonth)
+
+    accountUsage = pd.DataFrame.from_records(usageRows(), columns=PAAS_COLS).astype(PAAS_DTYPES, copy=False)
+    if closedUsage:
+        with shelve.open(os.path.join(cacheDir, "usage")) as cache:
+            cache.update(closedUsage)
     return accountUsage
 
 if __name__ == "__main__":
@@ -720,13 +934,14 @@ if __name__ == "__main__":
     parser.add_argument("--sendGridSubject", default=os.environ.get('sendGridSubject', None), help="SendGrid email subject for output email")
     parser.add_argument("--output", default=os.environ.get('output', 'invoice-analysis.xlsx'), help="Filename Excel output file. (including extension of .xlsx)")
     parser.add_argument("--SL_PRIVATE", default=False, action=argparse.BooleanOptionalAction, help="Use IBM Cloud Classic Private API Endpoint")
+    parser.add_argument("--cache-dir", dest="cache_dir", default=os.environ.get('cache_dir', None), help="Directory to cache invoice line items and closed months of PaaS usage in so re-runs only retrieve new data.")
+    parser.add_argument("--segment-rows", dest="segment_rows", type=int, default=int(os.environ.get('segment_rows', 500000)), help="Split the report into one Excel file per IBM invoice month when detail exceeds this many rows. (0 to disable)")
 
     args = parser.parse_args()
 
     if args.months != None:
         months = int(args.months)
-        dallas=tz.gettz('US/Central')
-        today=datetime.today().astimezone(dallas)
+        today=datetime.today().astimezone(DALLAS)
         if today.day > 19:
             enddate=today.strftime('%Y-%m')
             startdate = today - relativedelta(months=months-1)
@@ -739,52 +954,79 @@ if __name__ == "__main__":
     else:
         if args.startdate == None or args.enddate == None:
             logging.error("You must provide either a number of months (-m) or a start (-s) and end month (-e) in the format of YYYY-MM.")
-            quit()
+            sys.exit(1)
         else:
             startdate = args.startdate
             enddate = args.enddate
 
     if args.IC_API_KEY == None:
         logging.error("You must provide an IBM Cloud ApiKey with billing View authority to run script.")
-        quit()
+        sys.exit(1)
 
     IC_API_KEY = args.IC_API_KEY
 
     # Calculate invoice dates based on SLIC invoice cutoffs.
     startdate, enddate = getInvoiceDates(startdate, enddate)
 
-    # Change endpoint to private Endpoint if command line open chosen
+    # Change endpoint to private Endpoint if command line open chosen.  Use the REST endpoints, the SoftLayer client
+    # selects its JSON transport for them which decodes large invoice pages much faster than XML-RPC unmarshalling.
     if args.SL_PRIVATE:
-        SL_ENDPOINT = "https://api.service.softlayer.com/xmlrpc/v3.1"
+        SL_ENDPOINT = "https://api.service.softlayer.com/rest/v3.1"
     else:
-        SL_ENDPOINT = "https://api.softlayer.com/xmlrpc/v3.1"
+        SL_ENDPOINT = "https://api.softlayer.com/rest/v3.1"
+
+    if args.cache_dir != None:
+        pathlib.Path(args.cache_dir).mkdir(parents=True, exist_ok=True)
 
     #  Retrieve Invoices from classic
-    classicUsage = getInvoiceDetail(IC_API_KEY, SL_ENDPOINT, startdate, enddate)
+    classicUsage = getInvoiceDetail(IC_API_KEY, SL_ENDPOINT, startdate, enddate, args.cache_dir)
 
-    # Retrieve Usage from IBM Cloud
-    IC_ACCOUNT_ID = getAccountId(IC_API_KEY)
+    # Retrieve Usage from IBM Cloud, one authenticator is shared by both services so the IAM token is only requested once
+    try:
+        authenticator = IAMAuthenticator(IC_API_KEY)
+    except ApiException as e:
+        logging.error("API exception {}.".format(str(e)))
+        logging.error("API status code {}.".format(e.code))
+        sys.exit(1)
 
-    paasUsage = accountUsage(IC_API_KEY, IC_ACCOUNT_ID, startdate, enddate)
+    IC_ACCOUNT_ID = getAccountId(authenticator, IC_API_KEY)
 
-    # Build Exel Report
-    createReport(args.output, classicUsage, paasUsage)
+    paasUsage = accountUsage(authenticator, IC_ACCOUNT_ID, startdate, enddate, args.cache_dir)
 
-    if args.sendGridApi != None:
-        sendEmail(startdate, enddate, args.sendGridTo, args.sendGridFrom, args.sendGridSubject, args.sendGridApi, args.output)
+    # xlsxwriter slows down sharply past ~500k rows and Excel is slow to open such files, so split large reports into
+    # one file per IBM invoice month named <output>_<YYYY-MM>.xlsx
+    output = pathlib.Path(args.output)
+    if args.segment_rows > 0 and len(classicUsage) > args.segment_rows:
+        logging.info("Detail has {} rows, splitting report by IBM invoice month.".format(len(classicUsage)))
+        # generate each month's slice as its report is written, so only one segment copy is held at a time
+        reports = ((output.with_name("{}_{}{}".format(output.stem, month, output.suffix)), monthUsage, paasUsage[paasUsage["invoiceMonth"] == month])
+                   for month, monthUsage in classicUsage.groupby("IBM_Invoice_Month", sort=False))
+    else:
+        reports = [(output, classicUsage, paasUsage)]
 
-    # upload created file to COS if COS credentials provided
+    # upload created files to COS if COS credentials provided, ibm_boto3 is only imported when it is needed
     if args.COS_APIKEY != None:
+        import ibm_boto3
+        import ibm_boto3.s3.transfer
+        from ibm_botocore.client import Config, ClientError
         cos = ibm_boto3.resource("s3",
                                  ibm_api_key_id=args.COS_APIKEY,
                                  ibm_service_instance_id=args.COS_INSTANCE_CRN,
                                  config=Config(signature_version="oauth"),
                                  endpoint_url=args.COS_ENDPOINT
                                  )
-        multi_part_upload(args.COS_BUCKET, args.output, "./" + args.output)
 
-    if args.sendGridApi != None or args.COS_APIKEY != None:
-        #cleanup file if written to COS or sendvia email
-        logging.info("Deleting {} local file.".format(args.output))
-        os.remove("./"+args.output)
+    for outputName, reportClassicUsage, reportPaasUsage in reports:
+        # Build Exel Report, if it is only being emailed or uploaded to COS build it in memory instead of writing it to disk
+        if args.sendGridApi != None or args.COS_APIKEY != None:
+            report = io.BytesIO()
+        else:
+            report = outputName
+        createReport(report, reportClassicUsage, reportPaasUsage)
+
+        if args.sendGridApi != None:
+            sendEmail(startdate, enddate, args.sendGridTo, args.sendGridFrom, args.sendGridSubject, args.sendGridApi, outputName.name, report)
+
+        if args.COS_APIKEY != None:
+            multi_part_upload(args.COS_BUCKET, outputName.as_posix(), report)
     logging.info("invoiceAnalysis complete.")
\ No newline at end of file